@@ -2,9 +2,12 @@
 # SPDX-License-Identifier: Apache-2.0
 
 # DeepSpeed Team
+import math
 import torch
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import time
+from collections import OrderedDict
 import deepspeed
 from deepspeed.runtime.zero.partition_parameters import ZeroParamStatus
 from deepspeed.accelerator import get_accelerator
@@ -13,33 +16,81 @@ from dschat.utils.utils import print_rank_0
 from transformers import pipeline
 
 
-def print_all_ranks(tag, value, rank):
+def print_all_ranks(tags, values, rank):
+    # one all_reduce for every tag: row i holds values[i] from each rank
     world_size = torch.distributed.get_world_size()
-    all_tensor = torch.zeros(world_size, dtype=torch.float32).to(
+    all_tensor = torch.zeros(len(tags), world_size, dtype=torch.float32).to(
         get_accelerator().current_device_name())
-    all_tensor[rank] = value
+    all_tensor[:, rank] = values
     torch.distributed.all_reduce(all_tensor, op=torch.distributed.ReduceOp.SUM)
-    print_rank_0(f'{tag} {all_tensor}', rank)
+    for tag, tag_values in zip(tags, all_tensor):
+        print_rank_0(f'{tag} {tag_values}', rank)
 
 
-def get_model_norm(model):
+def get_norm_params(model):
+    # split once per model: ZeRO-3 partitioned parameters need a gather, the
+    # rest are normed in one batch
+    params = list(model.parameters())
+    partitioned_params = [param for param in params if hasattr(param, 'ds_id')]
+    local_params = [param for param in params if not hasattr(param, 'ds_id')]
+    return partitioned_params, local_params
+
+
+def get_model_norm(model, norm_params=None):
+    if norm_params is None:
+        norm_params = get_norm_params(model)
+    partitioned_params, local_params = norm_params
     with torch.no_grad():
-        total = 0.0
-        for param in model.parameters():
-            should_gather = hasattr(
-                param,
-                'ds_id') and param.ds_status == ZeroParamStatus.NOT_AVAILABLE
-            with deepspeed.zero.GatheredParameters(param,
-                                                   enabled=should_gather):
-                total += float(param.float().norm())
+        # accumulate on device and sync once, instead of a host sync per parameter
+        total = torch.zeros((),
+                            dtype=torch.float32,
+                            device=get_accelerator().current_device_name())
+        if local_params:
+            total += torch.stack([
+                torch.linalg.vector_norm(param, dtype=torch.float32)
+                for param in local_params
+            ]).sum().to(total.device)
+        for param in partitioned_params:
+            # gathered one at a time so ZeRO-3 never materializes the whole model
+            with deepspeed.zero.GatheredParameters(
+                    param,
+                    enabled=param.ds_status == ZeroParamStatus.NOT_AVAILABLE):
+                total += torch.linalg.vector_norm(
+                    param, dtype=torch.float32).to(total.device)
 
     return total
 
 
-def gather_log_probs(logits, labels):
-    log_probs = F.log_softmax(logits, dim=-1)
-    log_probs_labels = log_probs.gather(dim=-1, index=labels.unsqueeze(-1))
-    return log_probs_labels.squeeze(-1) # returns probabilities of the chosen words
+def _gather_log_probs_fp32(logits, labels):
+    # log_softmax(x)[y] == x[y] - logsumexp(x), with the reduction and the
+    # subtraction in fp32: a bf16/fp16 logsumexp is rounded at its own
+    # magnitude (about 0.06 at 20 in bf16), which would swamp the log-prob
+    logits_labels = logits.gather(dim=-1,
+                                  index=labels.unsqueeze(-1)).squeeze(-1)
+    return logits_labels.float() - torch.logsumexp(logits.float(), dim=-1)
+
+
+def gather_log_probs(logits, labels, fp32=False, chunk_size=128):
+    # chunk_size positions at a time, so there is never an fp32 copy of the
+    # full (B, T, V) logits
+    use_checkpoint = torch.is_grad_enabled() and logits.requires_grad
+    log_probs = []
+    for logits_chunk, labels_chunk in zip(logits.split(chunk_size, dim=1),
+                                          labels.split(chunk_size, dim=1)):
+        if use_checkpoint:
+            # only the low-precision chunk is kept for backward, its fp32
+            # logsumexp is recomputed there
+            log_probs.append(
+                checkpoint(_gather_log_probs_fp32,
+                           logits_chunk,
+                           labels_chunk,
+                           use_reentrant=False))
+        else:
+            log_probs.append(_gather_log_probs_fp32(logits_chunk, labels_chunk))
+    log_probs = torch.cat(log_probs, dim=1)
+    if fp32:
+        return log_probs
+    return log_probs.to(logits.dtype) # returns log probabilities of the chosen words
 
 
 class DeepSpeedPPOTrainer():
@@ -49,18 +100,49 @@ class DeepSpeedPPOTrainer():
         self.actor_model = self.rlhf_engine.actor
         self.fact_critic_model = self.rlhf_engine.critic_fact
         self.gen_critic_model = self.rlhf_engine.critic_gen
+        # with a shared trunk both critics are the same two-head engine
+        self.share_critic_trunk = args.share_critic_trunk
         self.ref_model = self.rlhf_engine.ref
         self.fact_reward_model = self.rlhf_engine.reward_fact
         self.gen_reward_model = self.rlhf_engine.reward_gen
         self.tokenizer = self.rlhf_engine.tokenizer
+        # tokenizer.pad_token_id converts the pad token on every access
+        self.pad_token_id = self.tokenizer.pad_token_id
         self.args = args
         self.max_answer_seq_len = args.max_answer_seq_len
         self.end_of_conversation_token_id = self.tokenizer(
             args.end_of_conversation_token)['input_ids'][-1]
         self.z3_enabled = args.actor_zero_stage == 3
         self.compute_fp32_loss = self.args.compute_fp32_loss
-        self.fact_gen_classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
+        self.fact_gen_classifier = pipeline(
+            "zero-shot-classification",
+            model="facebook/bart-large-mnli",
+            device=torch.device(get_accelerator().current_device_name()))
         self.candidate_labels = ['factual question', 'generative question']
+        # The factual/generative weighting only depends on the prompt, so the
+        # classifier scores are cached by prompt token ids (LRU)
+        self.fact_prob_cache = OrderedDict()
+        self.fact_prob_cache_size = 8192
+
+        # The reward and critic forwards in generate_experience are independent of
+        # each other, so they are issued on separate streams to overlap. ZeRO-3
+        # engines fetch parameters on their own streams, so they stay serial.
+        # Overlapping raises peak activation memory, hence the opt-out.
+        self.inference_streams = None
+        if (not args.disable_inference_overlap and args.critic_zero_stage != 3
+                and get_accelerator().Stream is not None):
+            self.inference_streams = [
+                get_accelerator().Stream() for _ in range(4)
+            ]
+
+        # parameter lists for dump_model_norms, built once; with a shared critic
+        # trunk the two critic entries are the same engine and share one list
+        self._norm_params_by_model = {
+            model: get_norm_params(model)
+            for model in (self.actor_model, self.ref_model,
+                          self.fact_critic_model, self.gen_critic_model,
+                          self.fact_reward_model, self.gen_reward_model)
+        }
 
         # In case the generated experience is not valid (too short), we use the last valid
         # generated experience. Alternatively, we can skip the step (on all workers).
@@ -93,7 +175,7 @@ class DeepSpeedPPOTrainer():
                 prompts,
                 attention_mask=mask,
                 max_length=max_min_length,
-                pad_token_id=self.tokenizer.pad_token_id,
+                pad_token_id=self.pad_token_id,
                 synced_gpus=self.z3_enabled,
                 **kwargs)
 
@@ -103,10 +185,12 @@ class DeepSpeedPPOTrainer():
         prompt_length = prompts.shape[1]
         self.prompt_length = prompt_length
         ans = seq[:, prompt_length:]
-        valid_ans_len = (ans != self.tokenizer.pad_token_id).sum(dim=-1)
+        valid_ans_len = (ans != self.pad_token_id).sum(dim=-1)
 
-        if self.args.print_answers and (step % self.args.print_answers_interval
-                                        == 0):
+        # decoding is slow and only rank 0's output is kept, so other ranks skip it
+        is_rank_0 = torch.distributed.get_rank() == 0
+        if is_rank_0 and self.args.print_answers and (
+                step % self.args.print_answers_interval == 0):
             print(
                 f"--- prompt --> step={step}, rank={torch.distributed.get_rank()}, {self.tokenizer.batch_decode(prompts, skip_special_tokens=True)}"
             )
@@ -114,20 +198,11 @@ class DeepSpeedPPOTrainer():
                 f"--- ans    --> step={step}, rank={torch.distributed.get_rank()}, {self.tokenizer.batch_decode(ans, skip_special_tokens=True)}"
             )
 
-        out_seq = []
-        for i in range(batch_size):
-            if valid_ans_len[
-                    i] <= 1:  # if the answer is shorter than 1 token, drop it
-                print(
-                    f'Dropping too short generated answer: {step=}: \n'
-                    f'prompts: {self.tokenizer.batch_decode(prompts, skip_special_tokens=False)}\n'
-                    f'answers: {self.tokenizer.batch_decode(ans, skip_special_tokens=False)}'
-                )
-                continue
-            else:
-                out_seq.append(seq[i:i + 1])
+        # if the answer is shorter than 1 token, drop it
+        keep = valid_ans_len > 1
+        num_kept = int(keep.sum())  # the only host sync on the common path
 
-        if not out_seq:
+        if num_kept == 0:
             print(
                 f'All generated results are too short for rank={self.args.local_rank} step={step}\n'
                 f'-> prompts: {self.tokenizer.batch_decode(prompts, skip_special_tokens=False)}\n'
@@ -135,10 +210,72 @@ class DeepSpeedPPOTrainer():
             )
             return None
 
-        out_seq = torch.cat(out_seq, dim=0)  # concat output in the batch dim
+        if num_kept == batch_size:
+            return seq
+
+        if is_rank_0 and self.args.print_answers:
+            # only decode the dropped examples
+            print(
+                f'Dropping too short generated answer: {step=}: \n'
+                f'prompts: {self.tokenizer.batch_decode(prompts[~keep], skip_special_tokens=False)}\n'
+                f'answers: {self.tokenizer.batch_decode(ans[~keep], skip_special_tokens=False)}'
+            )
+        out_seq = seq[keep]
 
         return out_seq
 
+    def _get_fact_gen_probs(self, prompts):
+        keys = [tuple(prompt) for prompt in prompts.tolist()]
+        missing = list(
+            OrderedDict.fromkeys(key for key in keys
+                                 if key not in self.fact_prob_cache))
+        if missing:
+            # only the uncached prompts are decoded, and classified in one batch
+            prompt_sentences = self.tokenizer.batch_decode(
+                [list(key) for key in missing], skip_special_tokens=True)
+            results = self.fact_gen_classifier(prompt_sentences,
+                                               self.candidate_labels,
+                                               batch_size=len(missing))
+            for key, result in zip(missing, results):
+                self.fact_prob_cache[key] = result['scores'][
+                    result['labels'].index('factual question')]
+
+        fact_prob = []
+        for key in keys:
+            self.fact_prob_cache.move_to_end(key)
+            fact_prob.append(self.fact_prob_cache[key])
+        while len(self.fact_prob_cache) > self.fact_prob_cache_size:
+            self.fact_prob_cache.popitem(last=False)
+
+        fact_prob = torch.tensor(fact_prob,
+                                 dtype=torch.float32,
+                                 device=prompts.device)
+        # the two candidate labels are scored with a softmax, so they sum to 1
+        return fact_prob, 1.0 - fact_prob
+
+    def _run_inference_forwards(self, forward_fns):
+        if self.inference_streams is None:
+            return [forward_fn() for forward_fn in forward_fns]
+
+        current_stream = get_accelerator().current_stream()
+        outputs = []
+        for stream, forward_fn in zip(self.inference_streams, forward_fns):
+            # the inputs are produced on the current stream
+            stream.wait_stream(current_stream)
+            with get_accelerator().stream(stream):
+                outputs.append(forward_fn())
+        for stream, output in zip(self.inference_streams, outputs):
+            current_stream.wait_stream(stream)
+            # allocated on a side stream but consumed on the current one
+            for tensor in (output if isinstance(output, tuple) else (output, )):
+                tensor.record_stream(current_stream)
+        return outputs
+
+    def _get_shared_critic_values(self, input_ids, attention_mask, **kwargs):
+        values = self.fact_critic_model.forward_value(input_ids, attention_mask,
+                                                      **kwargs)
+        return values['fact_values'][:, :-1], values['gen_values'][:, :-1]
+
     def generate_experience(self, prompts, mask, step):
         self.eval()
         generate_start = time.time()
@@ -152,57 +289,90 @@ class DeepSpeedPPOTrainer():
             self.last_generated_experience = {'prompts': prompts, 'seq': seq}
         self.train()
 
-        pad_token_id = self.tokenizer.pad_token_id
-        attention_mask = seq.not_equal(pad_token_id).long()
+        attention_mask = seq.not_equal(self.pad_token_id).long()
+        # one past the last non-padding answer token, shared by the reward
+        # placement and the end-of-answer zeroing in train_rlhf
+        ends = prompts.shape[1] + attention_mask[:, prompts.shape[1]:].sum(1)
         with torch.no_grad():
             output = self.actor_model(seq, attention_mask=attention_mask)
             output_ref = self.ref_model(seq, attention_mask=attention_mask)
-            fact_reward_score = self.fact_reward_model.forward_value(
-                seq, attention_mask,
-                prompt_length=self.prompt_length)['chosen_end_scores'].detach(
-                ) # gives the score for each prompt-answer pair in generated experiences
-            gen_reward_score = self.gen_reward_model.forward_value(
-                seq, attention_mask,
-                prompt_length=self.prompt_length)['chosen_end_scores'].detach(
-                )
-            fact_values = self.fact_critic_model.forward_value(
-                seq, attention_mask, return_value_only=True).detach()[:, :-1]
-            gen_values = self.gen_critic_model.forward_value(
-                seq, attention_mask, return_value_only=True).detach()[:, :-1]
+            # the critic forwards are issued first so they are already queued
+            # behind anything in the reward forwards that waits on the host
+            if self.share_critic_trunk:
+                forward_fns = [
+                    lambda: self._get_shared_critic_values(seq, attention_mask)
+                ]
+            else:
+                forward_fns = [
+                    lambda: self.fact_critic_model.forward_value(
+                        seq, attention_mask, return_value_only=True).detach()[:, :-1],
+                    lambda: self.gen_critic_model.forward_value(
+                        seq, attention_mask, return_value_only=True).detach()[:, :-1],
+                ]
+            forward_fns += [
+                lambda: self.fact_reward_model.forward_value(
+                    seq, attention_mask,
+                    prompt_length=self.prompt_length)['chosen_end_scores'].detach(
+                    ), # gives the score for each prompt-answer pair in generated experiences
+                lambda: self.gen_reward_model.forward_value(
+                    seq, attention_mask,
+                    prompt_length=self.prompt_length)['chosen_end_scores'].detach(
+                    ),
+            ]
+            outputs = self._run_inference_forwards(forward_fns)
+            fact_reward_score, gen_reward_score = outputs[-2:]
+            if self.share_critic_trunk:
+                fact_values, gen_values = outputs[0]
+            else:
+                fact_values, gen_values = outputs[:2]
 
         logits = output.logits
         logits_ref = output_ref.logits
-        if self.compute_fp32_loss:
-            logits = logits.to(torch.float)
-            logits_ref = logits_ref.to(torch.float)
+
+        # classify the prompts of the kept sequences, short answers may have been dropped
+        fact_prob, gen_prob = self._get_fact_gen_probs(
+            seq[:, :prompts.shape[1]])
 
         self.generate_time = generate_end - generate_start
 
         return {
             'prompts': prompts, #
-            'logprobs': gather_log_probs(logits[:, :-1, :], seq[:, 1:]), # probs of chosen sequence with actor #
-            'ref_logprobs': gather_log_probs(logits_ref[:, :-1, :], seq[:,
-                                                                        1:]), # # probs of chosen sequence iwth reference supervised trained model
+            'logprobs': gather_log_probs(logits[:, :-1, :], seq[:, 1:],
+                                         fp32=self.compute_fp32_loss), # probs of chosen sequence with actor #
+            'ref_logprobs': gather_log_probs(logits_ref[:, :-1, :], seq[:, 1:],
+                                             fp32=self.compute_fp32_loss), # # probs of chosen sequence iwth reference supervised trained model
             'fact_value': fact_values, # value at each step of generation #
             'gen_value': gen_values, #
             'fact_rewards': fact_reward_score, # # scores for the whole prompt-answer by fact and gen
             'gen_rewards': gen_reward_score, #
+            'fact_prob': fact_prob, # classifier weight of the factual reward per prompt
+            'gen_prob': gen_prob, #
             'input_ids': seq, # prompt-answer generated using current actor #
+            'ends': ends, #
             "attention_mask": attention_mask #
         }
 
-    def compute_rewards(self, prompts, log_probs, ref_log_probs, reward_score,
-                        action_mask):
-
-        kl_divergence_estimate = -self.kl_ctl * (log_probs - ref_log_probs)
-        rewards = kl_divergence_estimate
+    def compute_rewards(self,
+                        prompts,
+                        log_probs,
+                        ref_log_probs,
+                        reward_score,
+                        action_mask,
+                        ends=None):
+
+        # KL penalty -kl_ctl * (log_probs - ref_log_probs), scaled in place so the
+        # rewards are assembled in a single (B, T) buffer
+        rewards = torch.sub(ref_log_probs, log_probs).mul_(self.kl_ctl)
         start = prompts.shape[1] - 1
-        ends = start + action_mask[:, start:].sum(1) + 1 # that action mask term sum gives the number of non padding words in the generated answer
-        reward_clip = torch.clamp(torch.tensor(reward_score), -self.clip_reward_value,
+        if ends is None:
+            ends = start + action_mask[:, start:].sum(1) + 1 # that action mask term sum gives the number of non padding words in the generated answer
+        reward_clip = torch.clamp(reward_score, -self.clip_reward_value,
                                   self.clip_reward_value)
-        batch_size = log_probs.shape[0]
-        for j in range(batch_size):
-            rewards[j, start:ends[j]][-1] += reward_clip[j]
+        # add each clipped score at the last position of its answer in one op;
+        # a full-length answer ends one past the last log prob
+        last = (ends - 1).clamp(max=rewards.size(1) - 1)
+        rewards.scatter_add_(1, last.unsqueeze(1),
+                             reward_clip.unsqueeze(1).to(rewards.dtype))
 
         return rewards
 
@@ -218,31 +388,19 @@ class DeepSpeedPPOTrainer():
         gen_values = inputs['gen_value']
         attention_mask = inputs['attention_mask']
         seq = inputs['input_ids']
+        ends = inputs['ends']
         start = prompts.size()[-1] - 1
         action_mask = attention_mask[:, 1:]
 
         fact_old_values = fact_values
         gen_old_values = gen_values
+        fact_prob = inputs['fact_prob']
+        gen_prob = inputs['gen_prob']
         with torch.no_grad():
-            prompt_sentences = self.tokenizer.batch_decode(prompts, skip_special_tokens=True)
-            ls_of_dic = self.fact_gen_classifier(prompt_sentences, self.candidate_labels)
-            fact_prob = []
-            gen_prob = []
-            for dic in ls_of_dic:
-                lab = dic['labels'][0]
-                if lab == 'factual question':
-                    fact_score = dic['scores'][0]
-                    gen_score = dic['scores'][1]
-                else:
-                    fact_score = dic['scores'][1]
-                    gen_score = dic['scores'][0]
-                fact_prob.append(fact_score)
-                gen_prob.append(gen_score)
-            
-            weighted_reward_score = [fact_reward_score[j]*fact_prob[j] + gen_reward_score[j]*gen_prob[j] for j in range(len(fact_prob))]
+            weighted_reward_score = fact_reward_score * fact_prob + gen_reward_score * gen_prob
             old_rewards = self.compute_rewards(prompts, log_probs,
                                                ref_log_probs, weighted_reward_score,
-                                               action_mask) 
+                                               action_mask, ends=ends)
 
         #     fact_old_rewards = self.compute_rewards(prompts, log_probs,
         #                                        ref_log_probs, fact_reward_score + gen_reward_score,
@@ -250,13 +408,13 @@ class DeepSpeedPPOTrainer():
         #     gen_old_rewards = self.compute_rewards(prompts, log_probs,
         #                                        ref_log_probs, gen_reward_score,
         #                                        action_mask)
-            ends = start + action_mask[:, start:].sum(1) + 1
             # we need to zero out the reward and value after the end of the conversation
             # otherwise the advantage/return will be wrong
-            for i in range(old_rewards.shape[0]):
-                old_rewards[i, ends[i]:] = 0
-                fact_old_values[i, ends[i]:] = 0
-                gen_old_values[i, ends[i]:] = 0
+            after_end = torch.arange(old_rewards.size(1),
+                                     device=ends.device).unsqueeze(0) >= ends.unsqueeze(1)
+            old_rewards.masked_fill_(after_end, 0)
+            fact_old_values.masked_fill_(after_end, 0)
+            gen_old_values.masked_fill_(after_end, 0)
             fact_advantages, fact_returns = self.get_advantages_and_returns(
                 fact_old_values, old_rewards, start)
             gen_advantages, gen_returns = self.get_advantages_and_returns(
@@ -265,8 +423,12 @@ class DeepSpeedPPOTrainer():
         ### process the new outputs
         batch = {'input_ids': seq, "attention_mask": attention_mask}
         actor_prob = self.actor_model(**batch, use_cache=False).logits
-        actor_log_prob = gather_log_probs(actor_prob[:, :-1, :], seq[:, 1:])
-        actor_loss = self.actor_loss_fn(actor_log_prob[:, start:],
+        # only the answer positions enter the actor loss, so skip the
+        # vocab-sized log-prob computation over the prompt
+        actor_log_prob = gather_log_probs(actor_prob[:, start:-1, :],
+                                          seq[:, start + 1:],
+                                          fp32=self.compute_fp32_loss)
+        actor_loss = self.actor_loss_fn(actor_log_prob,
                                         log_probs[:, start:], fact_advantages, gen_advantages,
                                         action_mask[:, start:])
         self.actor_model.backward(actor_loss)
@@ -274,12 +436,16 @@ class DeepSpeedPPOTrainer():
         if not self.args.align_overflow:
             self.actor_model.step()
 
-        fact_value = self.fact_critic_model.forward_value(**batch,
-                                                return_value_only=True,
-                                                use_cache=False)[:, :-1]
-        gen_value = self.gen_critic_model.forward_value(**batch,
-                                                return_value_only=True,
-                                                use_cache=False)[:, :-1]
+        if self.share_critic_trunk:
+            fact_value, gen_value = self._get_shared_critic_values(
+                **batch, use_cache=False)
+        else:
+            fact_value = self.fact_critic_model.forward_value(**batch,
+                                                    return_value_only=True,
+                                                    use_cache=False)[:, :-1]
+            gen_value = self.gen_critic_model.forward_value(**batch,
+                                                    return_value_only=True,
+                                                    use_cache=False)[:, :-1]
         fact_critic_loss = self.critic_loss_fn(fact_value[:, start:], fact_old_values[:,
                                                                        start:],
                                           fact_returns, action_mask[:, start:])
@@ -287,8 +453,11 @@ class DeepSpeedPPOTrainer():
                                                                        start:],
                                           gen_returns, action_mask[:, start:])
         critic_loss = fact_critic_loss + gen_critic_loss
-        self.fact_critic_model.backward(fact_critic_loss)
-        self.gen_critic_model.backward(gen_critic_loss)
+        if self.share_critic_trunk:
+            self.fact_critic_model.backward(critic_loss)
+        else:
+            self.fact_critic_model.backward(fact_critic_loss)
+            self.gen_critic_model.backward(gen_critic_loss)
 
         if self.args.align_overflow:
             actor_overflow = self.actor_model.optimizer.check_overflow(
@@ -318,7 +487,8 @@ class DeepSpeedPPOTrainer():
             self.actor_model.step()
 
         self.fact_critic_model.step()
-        self.gen_critic_model.step()
+        if not self.share_critic_trunk:
+            self.gen_critic_model.step()
 
         return actor_loss, fact_critic_loss, gen_critic_loss
 
@@ -367,15 +537,39 @@ class DeepSpeedPPOTrainer():
 
     def get_advantages_and_returns(self, values, rewards, start):
         # Adopted from https://github.com/CarperAI/trlx/blob/main/trlx/models/modeling_ppo.py#L134
-        lastgaelam = 0
-        advantages_reversed = []
+        # The recurrence A_t = delta_t + gamma * lam * A_{t+1} is evaluated for all
+        # timesteps at once as a discounted reverse cumulative sum:
+        # A_t = sum_k (gamma * lam)^(k - t) * delta_k
         length = rewards.size()[-1]
-        for t in reversed(range(start, length)):
-            nextvalues = values[:, t + 1] if t < length - 1 else 0.0
-            delta = rewards[:, t] + self.gamma * nextvalues - values[:, t]
-            lastgaelam = delta + self.gamma * self.lam * lastgaelam
-            advantages_reversed.append(lastgaelam)
-        advantages = torch.stack(advantages_reversed[::-1], dim=1)
+        # intermediates are updated in place to keep the allocations per call low
+        nextvalues = F.pad(values[:, start + 1:], (0, 1), value=0.0)
+        delta = torch.add(rewards[:, start:], nextvalues,
+                          alpha=self.gamma).sub_(values[:, start:])
+        discount = self.gamma * self.lam
+        if discount == 0:
+            advantages = delta
+        else:
+            answer_length = length - start
+            # discount**k underflows even float64 once k * log(1 / discount) passes
+            # ~745, so the scan runs over blocks short enough to keep the weights
+            # normal, carrying A at the start of each block into the one before
+            block = max(1, answer_length)
+            if discount < 1:
+                block = max(1, min(block, int(700 / -math.log(discount))))
+            weights = discount**torch.arange(
+                block, dtype=torch.float64, device=delta.device)
+            advantages = torch.empty_like(delta)
+            carry = None
+            for end in range(answer_length, 0, -block):
+                begin = max(0, end - block)
+                block_weights = weights[:end - begin]
+                discounted = delta[:, begin:end].double().mul_(
+                    block_weights).flip(1).cumsum_(1).flip(1)
+                if carry is not None:
+                    discounted.add_(carry.unsqueeze(1),
+                                    alpha=discount**(end - begin))
+                carry = discounted.div_(block_weights)[:, 0]
+                advantages[:, begin:end] = discounted
         returns = advantages + values[:, start:]
         return advantages.detach(), returns
 
@@ -406,26 +600,21 @@ class DeepSpeedPPOTrainer():
         self.ref_model.eval()
 
     def dump_model_norms(self, tag):
-        actor_model_norm = get_model_norm(self.actor_model)
-        ref_model_norm = get_model_norm(self.ref_model)
-        fact_critic_model_norm = get_model_norm(self.fact_critic_model)
-        gen_critic_model_norm = get_model_norm(self.gen_critic_model)
-
-        fact_reward_model_norm = get_model_norm(self.fact_reward_model)
-        gen_reward_model_norm = get_model_norm(self.gen_reward_model)
-
-        print_all_ranks(f'{tag} global_actor_model_norm', actor_model_norm,
-                        self.args.local_rank)
-        print_all_ranks(f'{tag} global_ref_model_norm', ref_model_norm,
-                        self.args.local_rank)
-        print_all_ranks(f'{tag} global_fact_critic_model_norm', fact_critic_model_norm,
-                        self.args.local_rank)
-        print_all_ranks(f'{tag} global_gen_critic_model_norm', gen_critic_model_norm,
-                        self.args.local_rank)
-        print_all_ranks(f'{tag} global_fact_reward_model_norm', fact_reward_model_norm,
-                        self.args.local_rank)
-        print_all_ranks(f'{tag} global_gen_reward_model_norm', gen_reward_model_norm,
-                        self.args.local_rank)
+        models = {
+            'actor': self.actor_model,
+            'ref': self.ref_model,
+            'fact_critic': self.fact_critic_model,
+            'gen_critic': self.gen_critic_model,
+            'fact_reward': self.fact_reward_model,
+            'gen_reward': self.gen_reward_model,
+        }
+        model_norms = {
+            model: get_model_norm(model, norm_params)
+            for model, norm_params in self._norm_params_by_model.items()
+        }
+        norms = torch.stack([model_norms[model] for model in models.values()])
+        print_all_ranks([f'{tag} global_{name}_model_norm' for name in models],
+                        norms, self.args.local_rank)
 
 
 class DeepSpeedPPOTrainerUnsupervised(DeepSpeedPPOTrainer):
@@ -63,10 +63,6 @@ class DeepSpeedRLHFEngine():
             fact_critic_model_name_or_path=fact_critic_model_name_or_path, gen_critic_model_name_or_path=gen_critic_model_name_or_path)
         # self.reward_gen = self._init_reward(
             
-        if self.args.critic_gradient_checkpointing:
-            self.critic_fact.gradient_checkpointing_enable()
-            self.critic_gen.gradient_checkpointing_enable()
-            
 
     def _init_actor(self, actor_model_name_or_path):
         stime = log_init("Actor")
@@ -144,7 +140,11 @@ class DeepSpeedRLHFEngine():
         stime = log_init("Ref")
         # DS Config
         zero_stage = self.args.actor_zero_stage
-        if zero_stage != 3:
+        if self.args.offload_reference_model:
+            # parameter offload only takes effect under ZeRO-3; the ref model only
+            # runs one forward per experience batch, so streaming it from CPU is cheap
+            zero_stage = 3
+        elif zero_stage != 3:
             # If actor is ZeRO-3 then we use it for everything, otherwise assume we have enough memory for ref model
             zero_stage = 0
         ds_config = get_eval_ds_config(self.args.offload_reference_model,
@@ -222,6 +222,24 @@ class DeepSpeedRLHFEngine():
             'train_batch_size'] = self.args.per_device_training_batch_size * torch.distributed.get_world_size(
             ) * self.args.gradient_accumulation_steps
 
+        if self.args.share_critic_trunk:
+            # A single trunk (from the factual critic) with a value head per reward,
+            # the generative head is loaded from the generative critic; the same
+            # engine is returned for both critics
+            critic_model = create_critic_model(
+                model_name_or_path=fact_critic_model_name_or_path,
+                tokenizer=self.tokenizer,
+                ds_config=ds_eval_config,
+                num_padding_at_beginning=self.args.num_padding_at_beginning,
+                rlhf_training=True,
+                dropout=self.args.critic_dropout,
+                zero_stage=self.args.critic_zero_stage,
+                gen_value_head_model_name_or_path=gen_critic_model_name_or_path)
+            critic_engine = self._init_critic_engine(critic_model, ds_config)
+
+            log_init("Critic", stime=stime)
+            return critic_engine, critic_engine
+
         # Model
         fact_critic_model = create_critic_model(
             model_name_or_path=fact_critic_model_name_or_path,
@@ -241,67 +259,53 @@ class DeepSpeedRLHFEngine():
             dropout=self.args.critic_dropout,
             zero_stage=self.args.critic_zero_stage)
 
+        fact_critic_engine = self._init_critic_engine(fact_critic_model,
+                                                      ds_config)
+        gen_critic_engine = self._init_critic_engine(gen_critic_model,
+                                                     ds_config)
+
+        log_init("Critic", stime=stime)
+        return fact_critic_engine, gen_critic_engine
+
+    def _init_critic_engine(self, critic_model, ds_config):
+        # Recompute critic activations in backward instead of storing them
+        if self.args.critic_gradient_checkpointing:
+            critic_model.gradient_checkpointing_enable()
+
         # LoRA
         if self.args.critic_lora_dim > 0:
-            fact_critic_model = convert_linear_layer_to_lora(
-                fact_critic_model, self.args.critic_lora_module_name,
+            critic_model = convert_linear_layer_to_lora(
+                critic_model, self.args.critic_lora_module_name,
                 self.args.critic_lora_dim)
             if self.args.only_optimize_lora:
-                fact_critic_model = only_optimize_lora_parameters(fact_critic_model)
-                fact_critic_model = make_model_gradient_checkpointing_compatible(
-                    fact_critic_model)
-                
-            gen_critic_model = convert_linear_layer_to_lora(
-                gen_critic_model, self.args.critic_lora_module_name,
-                self.args.critic_lora_dim)
-            if self.args.only_optimize_lora:
-                gen_critic_model = only_optimize_lora_parameters(gen_critic_model)
-                gen_critic_model = make_model_gradient_checkpointing_compatible(
-                    gen_critic_model)
+                critic_model = only_optimize_lora_parameters(critic_model)
+                critic_model = make_model_gradient_checkpointing_compatible(
+                    critic_model)
 
         # Optimizer
         AdamOptimizer = DeepSpeedCPUAdam if self.args.offload else FusedAdam
-        fact_optim_params = get_optimizer_grouped_parameters(
-            fact_critic_model, self.args.critic_weight_decay,
-            self.args.critic_lora_learning_rate)
-        gen_optim_params = get_optimizer_grouped_parameters(
-            gen_critic_model, self.args.critic_weight_decay,
+        optim_params = get_optimizer_grouped_parameters(
+            critic_model, self.args.critic_weight_decay,
             self.args.critic_lora_learning_rate)
-        fact_optim = AdamOptimizer(fact_optim_params,
-                              lr=self.args.critic_learning_rate,
-                              betas=(0.9, 0.95))
-        gen_optim = AdamOptimizer(gen_optim_params,
+        optim = AdamOptimizer(optim_params,
                               lr=self.args.critic_learning_rate,
                               betas=(0.9, 0.95))
 
         # LR Scheduler
-        fact_lr_scheduler = get_scheduler(
-            name=self.args.lr_scheduler_type,
-            optimizer=fact_optim,
-            num_warmup_steps=self.args.num_warmup_steps,
-            num_training_steps=self.num_total_iters,
-        )
-
-        gen_lr_scheduler = get_scheduler(
+        lr_scheduler = get_scheduler(
             name=self.args.lr_scheduler_type,
-            optimizer=gen_optim,
+            optimizer=optim,
             num_warmup_steps=self.args.num_warmup_steps,
             num_training_steps=self.num_total_iters,
         )
 
         # DeepSpeed Engine
-        fact_critic_engine, *_ = deepspeed.initialize(model=fact_critic_model,
-                                                 optimizer=fact_optim,
-                                                 lr_scheduler=fact_lr_scheduler,
-                                                 config=ds_config)
-        
-        gen_critic_engine, *_ = deepspeed.initialize(model=gen_critic_model,
-                                                 optimizer=gen_optim,
-                                                 lr_scheduler=gen_lr_scheduler,
+        critic_engine, *_ = deepspeed.initialize(model=critic_model,
+                                                 optimizer=optim,
+                                                 lr_scheduler=lr_scheduler,
                                                  config=ds_config)
 
-        log_init("Critic", stime=stime)
-        return fact_critic_engine, gen_critic_engine
+        return critic_engine
 
     def _init_reward(self, fact_critic_model_name_or_path, gen_critic_model_name_or_path):
         stime = log_init("Reward")
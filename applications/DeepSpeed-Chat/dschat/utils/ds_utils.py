@@ -88,7 +88,8 @@ def get_eval_ds_config(offload, dtype, stage=0):
         "stage": stage,
         "stage3_param_persistence_threshold": 1e4,
         "offload_param": {
-            "device": device
+            "device": device,
+            "pin_memory": offload
         },
         "memory_efficient_linear": False
     }
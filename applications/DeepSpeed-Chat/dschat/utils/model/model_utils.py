@@ -12,7 +12,7 @@ from transformers import (
 from huggingface_hub import snapshot_download
 from transformers.deepspeed import HfDeepSpeedConfig
 
-from dschat.utils.model.reward_model import RewardModel
+from dschat.utils.model.reward_model import RewardModel, TwoHeadCriticModel
 from dschat.utils.utils import load_state_dict_into_model, print_rank_0
 
 
@@ -115,6 +115,16 @@ def create_hf_model(model_class,
     return model
 
 
+def load_critic_state_dict(model_name_or_path):
+    if not os.path.isdir(model_name_or_path):
+        model_name_or_path = snapshot_download(model_name_or_path)
+    model_ckpt_path = os.path.join(model_name_or_path, 'pytorch_model.bin')
+    assert os.path.exists(
+        model_ckpt_path), f"Cannot find model checkpoint at {model_ckpt_path}"
+
+    return torch.load(model_ckpt_path, map_location='cpu')
+
+
 def create_critic_model(model_name_or_path,
                         tokenizer,
                         ds_config,
@@ -122,10 +132,15 @@ def create_critic_model(model_name_or_path,
                         rlhf_training=False,
                         dropout=None,
                         zero_stage=0,
-                        compute_fp32_loss=False):
+                        compute_fp32_loss=False,
+                        gen_value_head_model_name_or_path=None):
     # OPT model family always put a padding token at the beginning of the sequence,
     # we did not see this in other models but not sure if it is a general rule
 
+    # with gen_value_head_model_name_or_path the critic gets a second (generative)
+    # value head, taken from that checkpoint's value head
+    two_head_critic = gen_value_head_model_name_or_path is not None
+
     import time
 
     start = time.time()
@@ -135,7 +150,8 @@ def create_critic_model(model_name_or_path,
     print_rank_0(f">Creating model from_config took {end - start} seconds",
                  None)
 
-    critic_model = RewardModel(
+    critic_class = TwoHeadCriticModel if two_head_critic else RewardModel
+    critic_model = critic_class(
         critic_model,
         tokenizer,
         num_padding_at_beginning=num_padding_at_beginning,
@@ -143,16 +159,11 @@ def create_critic_model(model_name_or_path,
 
     if rlhf_training:
         # load critic model from checkpoint
-
-        if not os.path.isdir(model_name_or_path):
-            model_name_or_path = snapshot_download(model_name_or_path)
-        model_ckpt_path = os.path.join(model_name_or_path, 'pytorch_model.bin')
-        assert os.path.exists(
-            model_ckpt_path
-        ), f"Cannot find model checkpoint at {model_ckpt_path}"
-
         start = time.time()
-        model_ckpt_state_dict = torch.load(model_ckpt_path, map_location='cpu')
+        model_ckpt_state_dict = load_critic_state_dict(model_name_or_path)
+        if two_head_critic:
+            model_ckpt_state_dict['gen_v_head.weight'] = load_critic_state_dict(
+                gen_value_head_model_name_or_path)['v_head.weight']
         end = time.time()
         print_rank_0(f">Creating model from_config took {end - start} seconds",
                      None)
@@ -124,17 +124,8 @@ class RewardModel(nn.Module):
             "rejected_mean_scores": rejected_mean_scores,
         }
 
-    def forward_value(self,
-                      input_ids=None,
-                      attention_mask=None,
-                      past_key_values=None,
-                      position_ids=None,
-                      head_mask=None,
-                      inputs_embeds=None,
-                      return_value_only=False,
-                      prompt_length=0,
-                      use_cache=False):
-
+    def _trunk_hidden_states(self, input_ids, attention_mask, past_key_values,
+                             head_mask, inputs_embeds, use_cache):
         if self.config.model_type == "llama":
             kwargs = dict()
         else:
@@ -148,6 +139,22 @@ class RewardModel(nn.Module):
             use_cache=use_cache,
             **kwargs)
         hidden_states = transformer_outputs[0]
+        return hidden_states
+
+    def forward_value(self,
+                      input_ids=None,
+                      attention_mask=None,
+                      past_key_values=None,
+                      position_ids=None,
+                      head_mask=None,
+                      inputs_embeds=None,
+                      return_value_only=False,
+                      prompt_length=0,
+                      use_cache=False):
+
+        hidden_states = self._trunk_hidden_states(input_ids, attention_mask,
+                                                  past_key_values, head_mask,
+                                                  inputs_embeds, use_cache)
         values = self.v_head(hidden_states).squeeze(-1)
         if return_value_only:
             return values
@@ -156,19 +163,49 @@ class RewardModel(nn.Module):
             # [prompt, answer, 0, 0, 0, 0] this is normal
             assert prompt_length > 1, "prompt_length must be greater than 1 to help select the end score"
             bs = values.size(0)
-            seq_len = input_ids.shape[1]
-            chosen_end_scores = [
-            ]  # we use this name for consistency with the original forward function
-            for i in range(bs):
-                input_id = input_ids[i]
-                value = values[i]
-
-                c_inds = (input_id[prompt_length:] == self.PAD_ID).nonzero()
-                # here we only use the answer part of the sequence so we do not need to care about the padding at the beginning
-                c_ind = c_inds[0].item() + prompt_length if len(
-                    c_inds) > 0 else seq_len
-                chosen_end_scores.append(value[c_ind - 1]) ## gives score at last token after answer, like [prompt answer _ ]
+            # here we only use the answer part of the sequence so we do not need to care about the padding at the beginning
+            is_pad = input_ids[:, prompt_length:] == self.PAD_ID
+            # a trailing sentinel makes answers without padding end at seq_len;
+            # argmax returns the first pad, with no per-sample host sync
+            is_pad = torch.cat([is_pad, is_pad.new_ones(bs, 1)], dim=1)
+            c_ind = is_pad.int().argmax(dim=1) + prompt_length
+            # we use this name for consistency with the original forward function
+            chosen_end_scores = values.gather(
+                1, (c_ind - 1).unsqueeze(1)).squeeze(1) ## gives score at last token after answer, like [prompt answer _ ]
             return {
                 "values": values,
-                "chosen_end_scores": torch.stack(chosen_end_scores),
+                "chosen_end_scores": chosen_end_scores,
             }
+
+
+## A critic with a single transformer trunk and one value head per reward
+## (factual / generative), so both value estimates come from one forward
+class TwoHeadCriticModel(RewardModel):
+
+    def __init__(self,
+                 base_model,
+                 tokenizer,
+                 num_padding_at_beginning=0,
+                 compute_fp32_loss=False):
+        super().__init__(base_model,
+                         tokenizer,
+                         num_padding_at_beginning=num_padding_at_beginning,
+                         compute_fp32_loss=compute_fp32_loss)
+        self.gen_v_head = nn.Linear(self.v_head.in_features, 1, bias=False)
+
+    def forward_value(self,
+                      input_ids=None,
+                      attention_mask=None,
+                      past_key_values=None,
+                      position_ids=None,
+                      head_mask=None,
+                      inputs_embeds=None,
+                      use_cache=False):
+
+        hidden_states = self._trunk_hidden_states(input_ids, attention_mask,
+                                                  past_key_values, head_mask,
+                                                  inputs_embeds, use_cache)
+        return {
+            "fact_values": self.v_head(hidden_states).squeeze(-1),
+            "gen_values": self.gen_v_head(hidden_states).squeeze(-1),
+        }
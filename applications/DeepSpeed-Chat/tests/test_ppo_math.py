@@ -0,0 +1,130 @@
+# Copyright (c) Microsoft Corporation.
+# SPDX-License-Identifier: Apache-2.0
+
+# DeepSpeed Team
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+pytest.importorskip("deepspeed")
+pytest.importorskip("transformers")
+
+from dschat.rlhf.ppo_trainer import DeepSpeedPPOTrainer, gather_log_probs
+
+
+def make_trainer(gamma=1.0, lam=0.95):
+    # only the PPO hyperparameters are needed, so skip building the engines
+    trainer = DeepSpeedPPOTrainer.__new__(DeepSpeedPPOTrainer)
+    trainer.kl_ctl = 0.1
+    trainer.clip_reward_value = 5 * 2
+    trainer.gamma = gamma
+    trainer.lam = lam
+    return trainer
+
+
+def reference_advantages_and_returns(values, rewards, start, gamma, lam):
+    lastgaelam = 0
+    advantages_reversed = []
+    length = rewards.size()[-1]
+    for t in reversed(range(start, length)):
+        nextvalues = values[:, t + 1] if t < length - 1 else 0.0
+        delta = rewards[:, t] + gamma * nextvalues - values[:, t]
+        lastgaelam = delta + gamma * lam * lastgaelam
+        advantages_reversed.append(lastgaelam)
+    advantages = torch.stack(advantages_reversed[::-1], dim=1)
+    returns = advantages + values[:, start:]
+    return advantages, returns
+
+
+def reference_rewards(prompts, log_probs, ref_log_probs, reward_score,
+                      action_mask, kl_ctl, clip_reward_value):
+    rewards = -kl_ctl * (log_probs - ref_log_probs)
+    start = prompts.shape[1] - 1
+    ends = start + action_mask[:, start:].sum(1) + 1
+    reward_clip = torch.clamp(reward_score, -clip_reward_value,
+                              clip_reward_value)
+    for j in range(log_probs.shape[0]):
+        rewards[j, start:ends[j]][-1] += reward_clip[j]
+    return rewards
+
+
+def make_batch(prompt_len=4, answer_len=6):
+    torch.manual_seed(0)
+    batch_size = 3
+    seq_len = prompt_len + answer_len
+    prompts = torch.ones(batch_size, prompt_len, dtype=torch.long)
+    action_mask = torch.ones(batch_size, seq_len - 1, dtype=torch.long)
+    # the last sample runs to full length
+    action_mask[0, prompt_len + 1:] = 0
+    action_mask[1, seq_len - 3:] = 0
+    log_probs = torch.randn(batch_size, seq_len - 1)
+    ref_log_probs = torch.randn(batch_size, seq_len - 1)
+    reward_score = torch.tensor([3.0, -20.0, 12.0])
+    return prompts, log_probs, ref_log_probs, reward_score, action_mask
+
+
+def test_compute_rewards_placement():
+    trainer = make_trainer()
+    prompts, log_probs, ref_log_probs, reward_score, action_mask = make_batch()
+    expected = reference_rewards(prompts, log_probs, ref_log_probs,
+                                 reward_score, action_mask, trainer.kl_ctl,
+                                 trainer.clip_reward_value)
+    rewards = trainer.compute_rewards(prompts, log_probs, ref_log_probs,
+                                      reward_score, action_mask)
+    torch.testing.assert_close(rewards, expected)
+
+
+@pytest.mark.parametrize("gamma,lam", [(1.0, 0.95), (1.0, 1.0), (0.99, 0.5),
+                                       (1.0, 0.0)])
+def test_advantages_match_loop(gamma, lam):
+    trainer = make_trainer(gamma, lam)
+    prompts, log_probs, ref_log_probs, reward_score, action_mask = make_batch()
+    rewards = trainer.compute_rewards(prompts, log_probs, ref_log_probs,
+                                      reward_score, action_mask)
+    values = torch.randn_like(rewards)
+    start = prompts.shape[1] - 1
+    advantages, returns = trainer.get_advantages_and_returns(
+        values, rewards, start)
+    expected_advantages, expected_returns = reference_advantages_and_returns(
+        values, rewards, start, gamma, lam)
+    torch.testing.assert_close(advantages, expected_advantages)
+    torch.testing.assert_close(returns, expected_returns)
+
+
+def test_advantages_long_answer_with_small_discount():
+    # (gamma * lam)**t underflows float64 past ~1.07k steps at 0.5
+    trainer = make_trainer(1.0, 0.5)
+    torch.manual_seed(0)
+    rewards = torch.randn(2, 3000, dtype=torch.float64)
+    values = torch.randn(2, 3000, dtype=torch.float64)
+    advantages, returns = trainer.get_advantages_and_returns(
+        values, rewards, 5)
+    expected_advantages, expected_returns = reference_advantages_and_returns(
+        values, rewards, 5, 1.0, 0.5)
+    assert torch.isfinite(advantages).all()
+    torch.testing.assert_close(advantages, expected_advantages)
+    torch.testing.assert_close(returns, expected_returns)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_gather_log_probs_matches_log_softmax(dtype):
+    torch.manual_seed(0)
+    logits = (torch.randn(2, 300, 50) * 5 + 20).to(dtype)
+    labels = torch.randint(0, 50, (2, 300))
+    expected = F.log_softmax(logits.double(), dim=-1).gather(
+        dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
+    log_probs = gather_log_probs(logits, labels, fp32=True, chunk_size=64)
+    assert log_probs.dtype == torch.float32
+    torch.testing.assert_close(log_probs.double(), expected,
+                               rtol=0,
+                               atol=1e-5)
+    assert gather_log_probs(logits, labels).dtype == dtype
+
+    # the checkpointed chunks give the same gradient as log_softmax
+    leaf = logits.float().requires_grad_()
+    gather_log_probs(leaf, labels, chunk_size=64).sum().backward()
+    expected_leaf = logits.float().requires_grad_()
+    F.log_softmax(expected_leaf, dim=-1).gather(
+        dim=-1, index=labels.unsqueeze(-1)).sum().backward()
+    torch.testing.assert_close(leaf.grad, expected_leaf.grad)
@@ -252,7 +252,8 @@ def parse_args():
     parser.add_argument(
         '--offload_reference_model',
         action='store_true',
-        help='Enable ZeRO Offload techniques for reference model')
+        help='Enable ZeRO Offload techniques for reference model '
+        '(runs the reference model under ZeRO-3 with pinned CPU parameters)')
     parser.add_argument(
         '--actor_zero_stage',
         type=int,
@@ -270,7 +271,22 @@ def parse_args():
     parser.add_argument(
         '--critic_gradient_checkpointing',
         action='store_true',
-        help='Enable HF gradient checkpointing for Critic model.')
+        help=
+        'Enable HF gradient checkpointing for Critic model(s). Lowers critic activation memory, '
+        'which allows a larger --per_device_training_batch_size.')
+    parser.add_argument(
+        '--disable_inference_overlap',
+        action='store_true',
+        help=
+        'Run the reward and critic inference forwards of experience generation one after another '
+        'instead of on separate streams. Lowers peak activation memory.')
+    parser.add_argument(
+        '--share_critic_trunk',
+        action='store_true',
+        help=
+        'Use a single critic trunk (initialized from the factual critic) with separate factual and generative value heads '
+        '(the generative head is loaded from the generative critic), '
+        'so both values come from one forward/backward pass.')
     parser.add_argument(
         "--actor_dropout",
         type=float,
@@ -488,6 +504,12 @@ def main():
 
     args.global_rank = torch.distributed.get_rank()
 
+    if args.actor_zero_stage == 3 and not args.enable_hybrid_engine:
+        print_rank_0(
+            "WARNING: actor ZeRO-3 without --enable_hybrid_engine all-gathers the actor parameters for every generated token. "
+            "Enable the hybrid engine (optionally with --inference_tp_size) to run generation on DeepSpeed inference kernels.",
+            args.global_rank)
+
     unsupervised_training_enabled = args.unsupervised_dataset_name and args.unsupervised_dataset_config_name
     if unsupervised_training_enabled:
         # if we enable unsupervised training, we need to double the batch size for actor model